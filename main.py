@@ -1,133 +1,294 @@
+import gc
 import os
+import sys
 import subprocess
-import datetime
+import threading
+import concurrent.futures
 import argparse
-import tempfile
-import mimetypes
-from faster_whisper import WhisperModel
+import numpy as np
 
 
-def extract_audio(video_path, audio_path):
-    """从视频文件中提取音频。"""
+def decode_audio(input_path, duration=None):
+    """用 ffmpeg 将输入文件解码为 16 kHz 单声道 float32 波形，通过管道直接读入内存。
+
+    已知时长时按时长预分配缓冲区并用 readinto 填充，
+    避免先收集 bytes 再 frombuffer 的额外整段拷贝。
+    """
+    command = [
+        "ffmpeg",
+        "-v",
+        "error",
+        "-i",
+        input_path,
+        "-vn",
+        "-f",
+        "f32le",
+        "-acodec",
+        "pcm_f32le",
+        "-ar",
+        "16000",
+        "-ac",
+        "1",
+        "pipe:1",
+    ]
+    # 仅调试时打印完整命令，避免污染批量模式的 OK/ERR 输出
+    if os.environ.get("V2S_DEBUG"):
+        print(" ".join(command), file=sys.stderr)
     try:
-        command = [
-            "ffmpeg",
-            "-i",
-            video_path,
-            "-vn",
-            "-acodec",
-            "pcm_s16le",
-            "-ar",
-            "16000",
-            "-ac",
-            "1",
-            audio_path,
-            "-y",
-        ]
-        print(" ".join(command))
-        subprocess.run(command, check=True, capture_output=True)
-        print(f"音频已提取到: {audio_path}")
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
     except FileNotFoundError:
         raise FileNotFoundError(
             "ffmpeg 未找到。请确保已安装 ffmpeg 并将其添加到系统路径。"
         )
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"提取音频失败: {e.stderr.decode()}")
+    if duration is None:
+        raw, stderr = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"解码音频失败: {stderr.decode()}")
+        audio = np.frombuffer(raw, dtype=np.float32)
+    else:
+        # 后台线程同步排空 stderr，防止 ffmpeg 报错过多填满管道而互相阻塞
+        stderr_chunks = []
+        stderr_reader = threading.Thread(
+            target=lambda: stderr_chunks.append(process.stderr.read())
+        )
+        stderr_reader.start()
+
+        # 预留 1 秒余量应对时长估计的舍入误差
+        buf = np.empty(int(duration * 16000) + 16000, dtype=np.float32)
+        view = memoryview(buf).cast("B")
+        n = 0
+        while n < len(view):
+            read = process.stdout.readinto(view[n:])
+            if not read:
+                break
+            n += read
+        # 时长估计偏低时，剩余数据回退到 bytes 路径
+        tail = process.stdout.read()
+        stderr_reader.join()
+        process.wait()
+        if process.returncode != 0:
+            stderr = stderr_chunks[0] if stderr_chunks else b""
+            raise RuntimeError(f"解码音频失败: {stderr.decode()}")
+        audio = buf[: n // 4]
+        if tail:
+            audio = np.concatenate([audio, np.frombuffer(tail, dtype=np.float32)])
 
+    print(f"音频已解码: {len(audio) / 16000:.1f} 秒", file=sys.stderr)
+    return audio
+
+
+def transcribe_audio(model, audio, language=None, batch_size=4, vad_parameters=None):
+    """使用给定的 WhisperModel 转录音频波形。
+
+    通过 BatchedInferencePipeline 按 VAD 切分音频并批量送入编码器，
+    batch_size 越大吞吐越高（GPU 上收益尤为明显）。
+    vad_parameters 可调整静音跳过的灵敏度，减少进入编码器的音频量。
+    """
+    from faster_whisper import BatchedInferencePipeline
 
-def transcribe_audio(model, audio_path, language=None):
-    """使用给定的 WhisperModel 转录音频文件。"""
-    segments, info = model.transcribe(
-        audio_path,
+    pipeline = BatchedInferencePipeline(model=model)
+    segments, info = pipeline.transcribe(
+        audio,
         language=language,
+        batch_size=batch_size,
         word_timestamps=True,
         vad_filter=True,
+        vad_parameters=vad_parameters,
     )
     return segments, info
 
 
-def format_timestamp(seconds):
-    """格式化时间戳为 SRT 格式。
-    格式：HH:MM:SS,mmm
+def format_timestamp(seconds, separator=","):
+    """格式化时间戳为字幕时间轴格式。
+    格式：HH:MM:SS,mmm（SRT，默认）或 HH:MM:SS.mmm（VTT，separator="."）
     例如：00:01:23,456
     """
-    delta = datetime.timedelta(seconds=seconds)
-    hours = delta.seconds // 3600
-    minutes = (delta.seconds % 3600) // 60
-    seconds = delta.seconds % 60
-    milliseconds = delta.microseconds // 1000
+    total_ms = int(seconds * 1000)
+    hours, rem = divmod(total_ms, 3600_000)
+    minutes, rem = divmod(rem, 60_000)
+    seconds, milliseconds = divmod(rem, 1000)
 
-    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{milliseconds:03d}"
 
 
-def generate_srt(segments, output_srt_path):
-    """生成 SRT 字幕文件。"""
-    with open(output_srt_path, "w", encoding="utf-8") as srt_file:
+def generate_srt_and_vtt(segments, output_base, flush_every=100):
+    """单次遍历 segments，同时生成 SRT 和 VTT 字幕文件。
+
+    segments 是惰性生成器，遍历会驱动实际的转录计算，因此只遍历一次，
+    每个时间戳只格式化一次，VTT 形式由 SRT 形式替换分隔符得到。
+    字幕块先在列表中累积，每 flush_every 段合并写盘并 flush 一次，
+    转录尚未结束时即可读取部分结果。
+    """
+    output_srt_path = f"{output_base}.srt"
+    output_vtt_path = f"{output_base}.vtt"
+    srt_parts = []
+    vtt_parts = ["WEBVTT\n\n"]
+
+    # 1 MiB 缓冲：长转录下合并小块写入，减少系统调用次数
+    with open(
+        output_srt_path, "w", encoding="utf-8", buffering=1 << 20
+    ) as srt_file, open(
+        output_vtt_path, "w", encoding="utf-8", buffering=1 << 20
+    ) as vtt_file:
         for i, segment in enumerate(segments, 1):
             start_time = format_timestamp(segment.start)
             end_time = format_timestamp(segment.end)
             text = segment.text.strip()
 
-            # 写入字幕序号
-            srt_file.write(f"{i}\n")
-            # 写入时间轴
-            srt_file.write(f"{start_time} --> {end_time}\n")
-            # 写入字幕文本
-            srt_file.write(f"{text}\n")
-            # 写入空行分隔
-            srt_file.write("\n")
+            # SRT：序号 + 时间轴 (HH:MM:SS,mmm) + 文本 + 空行
+            srt_parts.append(f"{i}\n{start_time} --> {end_time}\n{text}\n\n")
+            # VTT：时间轴分隔符用 '.' (HH:MM:SS.mmm)，无序号
+            vtt_parts.append(
+                f"{start_time.replace(',', '.')} --> {end_time.replace(',', '.')}\n{text}\n\n"
+            )
 
-    print(f"SRT 字幕已生成: {output_srt_path}")
+            if i % flush_every == 0:
+                srt_file.write("".join(srt_parts))
+                srt_file.flush()
+                srt_parts.clear()
+                vtt_file.write("".join(vtt_parts))
+                vtt_file.flush()
+                vtt_parts.clear()
 
+        srt_file.write("".join(srt_parts))
+        vtt_file.write("".join(vtt_parts))
 
-def is_video_file(file_path):
-    """判断文件是否为视频文件。"""
-    mime_type, _ = mimetypes.guess_type(file_path)
-    return mime_type and mime_type.startswith("video/")
+    print(f"SRT 字幕已生成: {output_srt_path}", file=sys.stderr)
+    print(f"VTT 字幕已生成: {output_vtt_path}", file=sys.stderr)
 
 
-def create_subtitles(
-    video_path, output_base, model_size, device, compute_type, language=None
-):
-    """为视频文件创建 SRT 和 VTT 字幕文件，并根据参数初始化 WhisperModel。"""
+def probe_audio(file_path):
+    """用 ffprobe 探测首条音频流的编码、采样率、声道数和时长。"""
+    command = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "a:0",
+        "-show_entries",
+        "stream=codec_name,sample_rate,channels,duration",
+        "-of",
+        "csv=p=0",
+        file_path,
+    ]
     try:
-        # 初始化 WhisperModel
-        model = WhisperModel(model_size, device=device, compute_type=compute_type)
+        result = subprocess.run(command, capture_output=True, text=True)
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            "ffprobe 未找到。请确保已安装 ffmpeg 并将其添加到系统路径。"
+        )
+    if result.returncode != 0:
+        raise RuntimeError(f"探测音频流失败: {result.stderr}")
 
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=True) as tmp_audio:
-            temp_audio_path = tmp_audio.name
+    fields = result.stdout.strip().split(",")
+    if not fields or not fields[0]:
+        raise RuntimeError(f"未在文件中找到音频流: {file_path}")
 
-            # 判断文件类型，只有视频文件才需要提取音频
-            if is_video_file(video_path):
-                print(f"检测到视频文件: {video_path}")
-                extract_audio(video_path, temp_audio_path)
-            else:
-                print(f"检测到音频文件: {video_path}")
-                temp_audio_path = video_path
+    probe = {"codec_name": fields[0]}
+    if len(fields) > 1 and fields[1].isdigit():
+        probe["sample_rate"] = int(fields[1])
+    if len(fields) > 2 and fields[2].isdigit():
+        probe["channels"] = int(fields[2])
+    if len(fields) > 3:
+        try:
+            probe["duration"] = float(fields[3])
+        except ValueError:
+            pass
+    return probe
 
-            segments, info = transcribe_audio(model, temp_audio_path, language)
 
-            srt_output_path = f"{output_base}.srt"
-            generate_srt(segments, srt_output_path)
+def needs_run(video_path, output_base):
+    """判断是否需要重新转录：输出 SRT 缺失或比输入文件旧。"""
+    srt_path = f"{output_base}.srt"
+    return not os.path.exists(srt_path) or os.path.getmtime(
+        srt_path
+    ) < os.path.getmtime(video_path)
 
+
+def load_model(model_size, device, compute_type, cpu_threads=0, num_workers=1):
+    """构建 WhisperModel；CUDA 显存不足时自动降级到 int8 重试。"""
+    # 延迟导入 faster_whisper（会连带加载 ctranslate2/onnxruntime 等大依赖），
+    # 让 --help 与参数错误路径保持秒开
+    from faster_whisper import WhisperModel
+
+    try:
+        return WhisperModel(
+            model_size,
+            device=device,
+            compute_type=compute_type,
+            cpu_threads=cpu_threads,
+            num_workers=num_workers,
+        )
+    except RuntimeError as e:
+        if "out of memory" in str(e).lower() and compute_type != "int8":
             print(
-                f"检测到的语言: {info.language} (置信度: {info.language_probability:.2f})"
+                f"提示: 以 {compute_type} 加载模型显存不足，回退到 int8 重试。",
+                file=sys.stderr,
             )
+            return WhisperModel(
+                model_size,
+                device=device,
+                compute_type="int8",
+                cpu_threads=cpu_threads,
+                num_workers=num_workers,
+            )
+        raise
 
-    except FileNotFoundError as e:
-        print(f"错误: {e}")
-    except RuntimeError as e:
-        print(f"错误: {e}")
-    finally:
-        # 显式地卸载模型以释放资源 (如果适用)
-        del model
+
+def create_subtitles(
+    model, video_path, output_base, language=None, batch_size=4, vad_parameters=None
+):
+    """使用已构建的 WhisperModel 为视频文件创建 SRT 和 VTT 字幕文件。"""
+    # 用 ffprobe 探测音频流；mimetypes 会误判 .mkv/.webm 等容器
+    probe = probe_audio(video_path)
+    # 进度信息一律走 stderr，stdout 留给批量模式的 OK/ERR/SKIP 协议行
+    print(
+        f"检测到音频流: {probe['codec_name']}"
+        f" {probe.get('sample_rate', '?')} Hz {probe.get('channels', '?')} 声道",
+        file=sys.stderr,
+    )
+
+    if (
+        probe["codec_name"] in ("pcm_s16le", "pcm_f32le")
+        and probe.get("sample_rate") == 16000
+        and probe.get("channels") == 1
+    ):
+        # 输入已是 16 kHz 单声道 PCM，直接交给 Whisper，跳过重新编码
+        print("输入已符合 16 kHz 单声道 PCM，跳过重新编码", file=sys.stderr)
+        audio = video_path
+    else:
+        audio = decode_audio(video_path, probe.get("duration"))
+    segments, info = transcribe_audio(
+        model, audio, language, batch_size, vad_parameters
+    )
+
+    generate_srt_and_vtt(segments, output_base)
+
+    print(
+        f"检测到的语言: {info.language} (置信度: {info.language_probability:.2f})",
+        file=sys.stderr,
+    )
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="从视频或音频文件生成 SRT 字幕，并可配置 Whisper 模型。"
     )
-    parser.add_argument("video_path", help="输入视频文件的路径")
+    parser.add_argument(
+        "video_path", nargs="?", default=None, help="输入视频文件的路径"
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="批量模式：从标准输入逐行读取 'output_base\\tvideo_path'，只加载一次模型",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="批量模式下强制重新转录，即使输出字幕已比输入新",
+    )
     parser.add_argument(
         "-o",
         "--output_base",
@@ -144,6 +305,16 @@ if __name__ == "__main__":
         choices=["tiny", "small", "medium", "large-v2", "large-v3"],
         help="Whisper 模型大小 (默认为 'medium')",
     )
+    parser.add_argument(
+        "--model_path",
+        default=None,
+        help=(
+            "预转换的 CTranslate2 模型目录，优先于 --model_size。"
+            "可用 'ct2-transformers-converter --model openai/whisper-medium "
+            "--output_dir <dir> --quantization int8_float16' 预先转换，"
+            "冷启动时跳过下载和重新量化"
+        ),
+    )
     parser.add_argument(
         "--device",
         default="cpu",
@@ -152,18 +323,184 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--compute_type",
-        default="int8",
-        choices=["int8", "float16", "float32"],
-        help="计算类型 (默认为 'int8')",
+        default="auto",
+        choices=[
+            "auto",
+            "int8",
+            "int8_float16",
+            "int8_bfloat16",
+            "float16",
+            "bfloat16",
+            "float32",
+        ],
+        help="计算类型，由 CTranslate2 调度 (默认为 'auto'，自动选择设备上最快的类型)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=None,
+        help="批量推理的 batch 大小 (默认 CUDA 为 8，CPU 为 4)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="批量模式下并发转录的文件数，共享同一个模型 (默认为 1)",
+    )
+    parser.add_argument(
+        "--cpu_threads",
+        type=int,
+        default=None,
+        help="每次转录使用的 CPU 线程数 (默认为 CPU 核心数除以 workers)",
+    )
+    parser.add_argument(
+        "--vad_min_silence_ms",
+        type=int,
+        default=500,
+        help="VAD 判定为静音的最短时长，毫秒 (默认为 500，调大可跳过更多停顿)",
+    )
+    parser.add_argument(
+        "--vad_threshold",
+        type=float,
+        default=0.5,
+        help="VAD 语音概率阈值 (默认为 0.5，调低更激进地保留语音)",
     )
 
     args = parser.parse_args()
 
-    create_subtitles(
-        args.video_path,
-        args.output_base,
-        args.model_size,
-        args.device,
-        args.compute_type,
-        args.language,
-    )
+    if not args.batch and args.video_path is None:
+        parser.error("非批量模式下必须提供 video_path")
+
+    if args.batch_size is None:
+        args.batch_size = 8 if args.device == "cuda" else 4
+
+    # 文件级并行只对批量模式有意义；CPU 线程按 worker 数均分，避免超订
+    if args.workers > 1 and not args.batch:
+        print("提示: --workers 仅在 --batch 模式下生效，已忽略。", file=sys.stderr)
+        args.workers = 1
+    if args.cpu_threads is None:
+        args.cpu_threads = (
+            max(1, (os.cpu_count() or 1) // args.workers)
+            if args.device == "cpu"
+            else 0
+        )
+
+    vad_parameters = {
+        "min_silence_duration_ms": args.vad_min_silence_ms,
+        "threshold": args.vad_threshold,
+    }
+
+    # 根据设备能力提示更合适的默认值，避免 CPU/int8 组合的性能陷阱
+    if args.device == "cuda" and args.compute_type == "int8":
+        print(
+            "提示: CUDA 上 int8 通常慢于 float16/int8_float16，"
+            "建议使用 --compute_type auto 或 float16。",
+            file=sys.stderr,
+        )
+    if (
+        args.device == "cpu"
+        and (os.cpu_count() or 1) < 8
+        and args.model_size in ("medium", "large-v2", "large-v3")
+    ):
+        print(
+            f"提示: 当前 CPU 核心较少，'{args.model_size}' 模型可能慢于实时，"
+            "建议使用 --model_size small。",
+            file=sys.stderr,
+        )
+
+    # 初始化 WhisperModel（只加载一次，批量模式下在多个文件间复用）；
+    # 先置 None，构建失败时 finally 不会因未绑定变量掩盖真实错误
+    model = None
+    try:
+        if args.batch:
+            # 先读取并解析全部任务："output_base\tvideo_path"；
+            # 无制表符的行按协议报 ERR，不让解包异常拖垮整个批次，
+            # 已是最新的输出直接报 SKIP——全部跳过时连模型都不必加载
+            jobs = []
+            for line in sys.stdin:
+                line = line.rstrip("\n")
+                if not line.strip():
+                    continue
+                if "\t" not in line:
+                    print(
+                        f"ERR\t{line}\t行格式错误，应为 'output_base\\tvideo_path'",
+                        flush=True,
+                    )
+                    continue
+                output_base, video_path = line.split("\t", 1)
+                try:
+                    if not args.force and not needs_run(video_path, output_base):
+                        print(f"SKIP\t{output_base}.srt", flush=True)
+                        continue
+                except OSError:
+                    # 输入文件本身有问题时交给转录路径报 ERR
+                    pass
+                jobs.append((output_base, video_path))
+
+            if jobs:
+                # 模型加载失败影响所有任务，按协议为每个任务各报一行 ERR
+                try:
+                    model = load_model(
+                        args.model_path or args.model_size,
+                        args.device,
+                        args.compute_type,
+                        args.cpu_threads,
+                        args.workers,
+                    )
+                except (FileNotFoundError, RuntimeError) as e:
+                    for output_base, video_path in jobs:
+                        print(f"ERR\t{video_path}\t{e}", flush=True)
+                    jobs = []
+
+                def run_one(job):
+                    output_base, video_path = job
+                    try:
+                        create_subtitles(
+                            model,
+                            video_path,
+                            output_base,
+                            args.language,
+                            args.batch_size,
+                            vad_parameters,
+                        )
+                        return f"OK\t{output_base}.srt"
+                    except (FileNotFoundError, RuntimeError) as e:
+                        return f"ERR\t{video_path}\t{e}"
+
+                if args.workers > 1:
+                    # CTranslate2 的 transcribe 是线程安全的，多个文件共享一个模型并发转录
+                    with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=args.workers
+                    ) as pool:
+                        for result in pool.map(run_one, jobs):
+                            print(result, flush=True)
+                else:
+                    for job in jobs:
+                        print(run_one(job), flush=True)
+        else:
+            try:
+                model = load_model(
+                    args.model_path or args.model_size,
+                    args.device,
+                    args.compute_type,
+                    args.cpu_threads,
+                    args.workers,
+                )
+                create_subtitles(
+                    model,
+                    args.video_path,
+                    args.output_base,
+                    args.language,
+                    args.batch_size,
+                    vad_parameters,
+                )
+            except FileNotFoundError as e:
+                print(f"错误: {e}")
+            except RuntimeError as e:
+                print(f"错误: {e}")
+
+    finally:
+        # 显式地卸载模型以释放资源 (如果适用)
+        if model is not None:
+            del model
+            gc.collect()